@@ -6,7 +6,7 @@ import matplotlib.pyplot as plt
 from scipy.stats import pearsonr as corr
 import yaml
 
-from models import SparseCoding
+from models import SparseCoding, register_code_projection_hook, compile_model
 
 # Parameters
 N = 16  # number of sparse sources
@@ -27,13 +27,15 @@ def sample_signal():
     return s
 
 def criterion(S_, X, X_, l1_weight):
-    loss = torch.sum((X - X_) ** 2) + l1_weight * torch.sum(torch.abs(S_))
+    loss = F.mse_loss(X_, X, reduction='sum') + l1_weight * torch.sum(torch.abs(S_))
     return loss
 
 def train(model, X, lr, l1_weight):
+    compile_model(model)
     optim = torch.optim.Adam(model.parameters(), lr=lr)
+    register_code_projection_hook(model, optim)
     for i in range(num_step):
-        S_, X_ = model.forward(X)
+        S_, X_ = model(X)
         loss = criterion(S_, X, X_, l1_weight=l1_weight)
         optim.zero_grad()
         loss.backward()
@@ -357,7 +357,7 @@ from tqdm import tqdm
 import yaml
 from munkres import Munkres
 import json
-from models import SparseCoding, SparseAutoEncoder, GatedSAE, TopKSAE
+from models import SparseCoding, SparseAutoEncoder, GatedSAE, TopKSAE, register_decoder_norm_hook, register_code_projection_hook, compile_model
 from flop_counter import calculate_inference_flops, calculate_training_flops
 
 # Parameters
@@ -425,15 +425,18 @@ def mcc(z, z_):
     return np.mean(corrs)
 
 def train_model(model, X_train, S_train, num_step, lr, l1_weight):
+    compile_model(model)
     optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    register_decoder_norm_hook(model, optimizer)
+    register_code_projection_hook(model, optimizer)
     best_mcc = -float('inf')
     
     for i in tqdm(range(num_step), desc=f"Training {model.__class__.__name__}"):
         if isinstance(model, GatedSAE):
             S_, X_, loss = model.loss_forward(X_train, l1_weight=l1_weight)
         else:
-            S_, X_ = model.forward(X_train)
-            loss = torch.sum((X_train - X_) ** 2) + l1_weight * torch.sum(torch.abs(S_))
+            S_, X_ = model(X_train)
+            loss = F.mse_loss(X_, X_train, reduction='sum') + l1_weight * torch.sum(torch.abs(S_))
         
         optimizer.zero_grad()
         loss.backward()
@@ -473,7 +476,7 @@ def run_experiment(model_class, hidden_dim, X_train, S_train, D, X_test, S_test,
         S_test_, _, _ = model.loss_forward(X_test, l1_weight=l1_weight)
         num_iterations = None
     else:
-        S_test_, _ = model.forward(X_test)
+        S_test_, _ = model(X_test)
         num_iterations = None
     
     test_mcc = mcc(S_test.cpu().numpy(), S_test_.detach().cpu().numpy())
@@ -0,0 +1,70 @@
+// Batched top-k over the rows of a contiguous float32 (B, N) matrix.
+// Each row keeps a size-k min-heap; the scan compares 8 floats at a time against the
+// current heap minimum with AVX2 and only touches the heap for the (rare) survivors.
+// NaNs are only detected, not ranked: the caller falls back to torch.topk when the result is nonzero.
+// Build: cc -O3 -march=native -mavx2 -fPIC -shared fast_topk.c -o libfast_topk.so
+// (no -ffast-math, which would let the compiler drop the NaN checks)
+#include <stdint.h>
+#ifdef __AVX2__
+#include <immintrin.h>
+#endif
+
+static void sift_down(float *vals, int64_t *idxs, int64_t k, int64_t i) {
+    for (;;) {
+        int64_t smallest = i, l = 2 * i + 1, r = l + 1;
+        if (l < k && vals[l] < vals[smallest]) smallest = l;
+        if (r < k && vals[r] < vals[smallest]) smallest = r;
+        if (smallest == i) return;
+        float v = vals[i]; vals[i] = vals[smallest]; vals[smallest] = v;
+        int64_t t = idxs[i]; idxs[i] = idxs[smallest]; idxs[smallest] = t;
+        i = smallest;
+    }
+}
+
+static inline void push(float *vals, int64_t *idxs, int64_t k, float v, int64_t j) {
+    if (v > vals[0]) {
+        vals[0] = v;
+        idxs[0] = j;
+        sift_down(vals, idxs, k, 0);
+    }
+}
+
+// returns 1 if the row contains a NaN
+static int topk_row(const float *x, int64_t N, int64_t k, float *vals, int64_t *idxs) {
+    int has_nan = 0;
+    if (k <= 0) return 0;  // nothing to keep, and push() would read vals[0]
+    for (int64_t j = 0; j < k; j++) {
+        vals[j] = x[j];
+        idxs[j] = j;
+        has_nan |= x[j] != x[j];
+    }
+    for (int64_t i = k / 2 - 1; i >= 0; i--) sift_down(vals, idxs, k, i);
+
+    int64_t j = k;
+#ifdef __AVX2__
+    __m256 nan_acc = _mm256_setzero_ps();
+    for (; j + 8 <= N; j += 8) {
+        __m256 v = _mm256_loadu_ps(x + j);
+        nan_acc = _mm256_or_ps(nan_acc, _mm256_cmp_ps(v, v, _CMP_UNORD_Q));
+        int mask = _mm256_movemask_ps(_mm256_cmp_ps(v, _mm256_set1_ps(vals[0]), _CMP_GT_OQ));
+        while (mask) {
+            int b = __builtin_ctz(mask);
+            push(vals, idxs, k, x[j + b], j + b);
+            mask &= mask - 1;
+        }
+    }
+    has_nan |= _mm256_movemask_ps(nan_acc) != 0;
+#endif
+    for (; j < N; j++) {
+        has_nan |= x[j] != x[j];
+        push(vals, idxs, k, x[j], j);
+    }
+    return has_nan;
+}
+
+int fast_topk_batched(const float *x, int64_t B, int64_t N, int64_t k, float *out_vals, int64_t *out_idxs) {
+    int has_nan = 0;
+    #pragma omp parallel for schedule(static) reduction(|:has_nan)
+    for (int64_t b = 0; b < B; b++) has_nan |= topk_row(x + b * N, N, k, out_vals + b * k, out_idxs + b * k);
+    return has_nan;
+}
@@ -0,0 +1,151 @@
+import torch
+from torch.nn import functional as F
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+
+def _use_triton(*tensors):
+    return triton is not None and all(t.is_cuda for t in tensors)
+
+
+### Fused TopK-SAE decoder + loss ###
+
+if triton is not None:
+    @triton.jit
+    def _topk_sae_loss_kernel(indices_ptr, values_ptr, weight_ptr, bias_ptr, target_ptr,
+                              recon_ptr, row_loss_ptr, M, K, BLOCK_M: tl.constexpr):
+        # one program per row: recon = bias + sum_i values[i] * weight[indices[i]]
+        row = tl.program_id(0)
+        row_loss = tl.zeros([BLOCK_M], dtype=tl.float32)
+        for m_start in range(0, M, BLOCK_M):
+            offs = m_start + tl.arange(0, BLOCK_M)
+            mask = offs < M
+            recon = tl.load(bias_ptr + offs, mask=mask, other=0.0).to(tl.float32)
+            for i in range(K):
+                index = tl.load(indices_ptr + row * K + i)
+                value = tl.load(values_ptr + row * K + i).to(tl.float32)
+                w = tl.load(weight_ptr + index * M + offs, mask=mask, other=0.0).to(tl.float32)
+                recon += value * w
+            target = tl.load(target_ptr + row * M + offs, mask=mask, other=0.0).to(tl.float32)
+            tl.store(recon_ptr + row * M + offs, recon, mask=mask)
+            diff = tl.where(mask, recon - target, 0.0)
+            row_loss += diff * diff
+        tl.store(row_loss_ptr + row, tl.sum(row_loss, axis=0))
+
+
+class _TopKSAELoss(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, indices, weight, values, bias, target):
+        indices, weight, values = indices.contiguous(), weight.contiguous(), values.contiguous()
+        bias, target = bias.contiguous(), target.contiguous()
+        B, K = indices.shape
+        M = weight.shape[1]
+        recon = torch.empty(B, M, device=target.device, dtype=torch.float32)
+        row_loss = torch.empty(B, device=target.device, dtype=torch.float32)
+        BLOCK_M = min(triton.next_power_of_2(M), 1024)
+        _topk_sae_loss_kernel[(B,)](indices, values, weight, bias, target,
+                                    recon, row_loss, M, K, BLOCK_M=BLOCK_M)
+        ctx.save_for_backward(indices, weight, values, recon, target)
+        ctx.bias_dtype = bias.dtype
+        ctx.mark_non_differentiable(recon)
+        return row_loss.sum(), recon
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_recon_unused):
+        indices, weight, values, recon, target = ctx.saved_tensors
+        bias_dtype = ctx.bias_dtype
+        B, K = indices.shape
+        M = weight.shape[1]
+        grad_recon = 2 * grad_loss * (recon - target)
+        grad_weight = grad_values = grad_bias = grad_target = None
+        if ctx.needs_input_grad[1]:
+            outer = values.unsqueeze(-1).to(grad_recon.dtype) * grad_recon.unsqueeze(1)
+            grad_weight = torch.zeros(weight.shape, device=weight.device, dtype=grad_recon.dtype)
+            grad_weight.index_add_(0, indices.view(-1), outer.view(-1, M))
+            grad_weight = grad_weight.to(weight.dtype)
+        if ctx.needs_input_grad[2]:
+            rows = weight.index_select(0, indices.view(-1)).view(B, K, M).to(grad_recon.dtype)
+            grad_values = torch.bmm(rows, grad_recon.unsqueeze(-1)).squeeze(-1).to(values.dtype)
+        if ctx.needs_input_grad[3]:
+            grad_bias = grad_recon.sum(0).to(bias_dtype)
+        if ctx.needs_input_grad[4]:
+            grad_target = -grad_recon.to(target.dtype)
+        return None, grad_weight, grad_values, grad_bias, grad_target
+
+
+def topk_sae_loss(indices, weight, values, bias, target):
+    """Summed squared error of the TopK-SAE reconstruction bias + values @ weight[indices].
+
+    Returns (loss, reconstruction). On CUDA with triton installed this runs a fused gather/decode/MSE
+    kernel that never materialises the dense (B, N) code; the returned reconstruction is then a
+    by-product and carries no gradient.
+    """
+    shape = target.shape
+    indices, values = indices.reshape(-1, indices.shape[-1]), values.reshape(-1, values.shape[-1])
+    target = target.reshape(-1, shape[-1])
+    if _use_triton(indices, weight, values, bias, target):
+        loss, recon = _TopKSAELoss.apply(indices, weight, values, bias, target)
+    else:
+        B, K = indices.shape
+        rows = weight.index_select(0, indices.reshape(-1)).view(B, K, -1)
+        recon = torch.baddbmm(bias.expand(B, 1, -1), values.unsqueeze(1), rows).squeeze(1)
+        loss = F.mse_loss(recon, target, reduction='sum')
+    return loss, recon.view(shape)
+
+
+### Fused MSE + L1 loss for SparseCoding.infer ###
+
+if triton is not None:
+    @triton.jit
+    def _mse_l1_loss_kernel(recon_ptr, target_ptr, codes_ptr, partial_ptr, num_recon, num_codes,
+                            inv_num_recon, l1_weight, BLOCK: tl.constexpr):
+        # each program reduces one block of (recon, target) and one block of codes
+        pid = tl.program_id(0)
+        offs = pid * BLOCK + tl.arange(0, BLOCK)
+        mask = offs < num_recon
+        recon = tl.load(recon_ptr + offs, mask=mask, other=0.0).to(tl.float32)
+        target = tl.load(target_ptr + offs, mask=mask, other=0.0).to(tl.float32)
+        diff = recon - target
+        mask = offs < num_codes
+        codes = tl.load(codes_ptr + offs, mask=mask, other=0.0).to(tl.float32)
+        partial = tl.sum(diff * diff, axis=0) * inv_num_recon + l1_weight * tl.sum(tl.abs(codes), axis=0)
+        tl.store(partial_ptr + pid, partial)
+
+
+class _MSEL1Loss(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, recon, target, codes, l1_weight):
+        recon, target, codes = recon.contiguous(), target.contiguous(), codes.contiguous()
+        BLOCK = 1024
+        num_blocks = triton.cdiv(max(recon.numel(), codes.numel()), BLOCK)
+        partial = torch.empty(num_blocks, device=recon.device, dtype=torch.float32)
+        _mse_l1_loss_kernel[(num_blocks,)](recon, target, codes, partial, recon.numel(), codes.numel(),
+                                           1.0 / recon.numel(), l1_weight, BLOCK=BLOCK)
+        ctx.save_for_backward(recon, target, codes)
+        ctx.l1_weight = l1_weight
+        return partial.sum()
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        recon, target, codes = ctx.saved_tensors
+        grad_recon = grad_target = grad_codes = None
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[1]:
+            grad_diff = (2.0 / recon.numel()) * grad_loss * (recon.float() - target.float())
+            if ctx.needs_input_grad[0]:
+                grad_recon = grad_diff.to(recon.dtype)
+            if ctx.needs_input_grad[1]:
+                grad_target = -grad_diff.to(target.dtype)
+        if ctx.needs_input_grad[2]:
+            grad_codes = (ctx.l1_weight * grad_loss * torch.sign(codes)).to(codes.dtype)
+        return grad_recon, grad_target, grad_codes, None
+
+
+def mse_l1_loss(recon, target, codes, l1_weight):
+    """F.mse_loss(recon, target) + l1_weight * |codes|.sum(), as one Triton reduction on CUDA."""
+    if _use_triton(recon, target, codes):
+        return _MSEL1Loss.apply(recon, target, codes, float(l1_weight))
+    return F.mse_loss(recon, target) + l1_weight * torch.sum(torch.abs(codes))
@@ -15,7 +15,7 @@ from scipy.fft import dct
 import einops
 import yaml
 
-from models import SparseCoding, SparseAutoEncoder, GatedSAE, TopKSAE
+from models import SparseCoding, SparseAutoEncoder, GatedSAE, TopKSAE, register_decoder_norm_hook, register_code_projection_hook, compile_model
 
 # parameters
 N = 16  # number of sparse sources
@@ -30,16 +30,19 @@ device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
 def criterion(S_, X, X_, l1_weight=l1_weight):
-    loss = torch.sum((X - X_) ** 2) + l1_weight * torch.sum(torch.abs(S_))
+    loss = F.mse_loss(X_, X, reduction='sum') + l1_weight * torch.sum(torch.abs(S_))
     return loss
 
 def train(model):
+    compile_model(model)
     optim = torch.optim.Adam(model.parameters(), lr=lr)
+    register_decoder_norm_hook(model, optim)
+    register_code_projection_hook(model, optim)
     for i in range(num_step):
         if isinstance(model, GatedSAE):
             S_, X_, loss = model.loss_forward(X, l1_weight=l1_weight)
         else:
-            S_, X_ = model.forward(X)
+            S_, X_ = model(X)
             loss = criterion(S_, X, X_, l1_weight=l1_weight)
         optim.zero_grad()
         loss.backward()
@@ -2,44 +2,134 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 import einops
-from typing import Callable, Any
+from typing import Callable, Any, NamedTuple, Optional
 from tqdm import tqdm
+from kernels import mse_l1_loss, topk_sae_loss
+from topk import approx_topk, cpu_topk
+
+def _autocast(device):
+    # bf16 (tensor-core) matmuls on CUDA; callers cast results back to fp32 so losses accumulate in fp32
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda')
+
+
+def _decode(S_: torch.Tensor, D_: torch.Tensor, bias: Optional[torch.Tensor] = None) -> torch.Tensor:
+    # shared dense decoder; a bias is folded into the GEMM epilogue via addmm
+    if bias is None:
+        return S_ @ D_
+    return torch.addmm(bias, S_, D_)
+
+
+def compile_model(model):
+    # Opt-in torch.compile for the training scripts; call it after .to(device). CUDA models are compiled
+    # in the default mode, with Inductor's automatic dynamic shapes covering the different batch sizes
+    # (instances of a class share the compiled code); CPU models stay eager. loss_forward calls self(X)
+    # (except in TopKSAE), so it goes through the compiled path too.
+    if next(model.parameters()).is_cuda:
+        model.compile()
+    return model
+
+
+def register_decoder_norm_hook(model, optimizer):
+    # Keep the rows of a learned D_ unit norm by renormalising once after every optimizer step
+    # (instead of on every forward). Returns the hook handle, or None if D_ is fixed.
+    if not model.learn_D:
+        return None
+
+    @torch.no_grad()
+    def hook(optimizer, args, kwargs):
+        model.D_ /= torch.linalg.norm(model.D_, dim=1, keepdim=True)
+
+    return optimizer.register_step_post_hook(hook)
+
+
+def register_code_projection_hook(model, optimizer):
+    # Keep the codes of a SparseCoding model non-negative by clamping S_raw_ after every optimizer
+    # step, the same projection infer() uses. Returns the hook handle, or None for models without codes.
+    if not isinstance(model, SparseCoding):
+        return None
+
+    @torch.no_grad()
+    def hook(optimizer, args, kwargs):
+        model.S_raw_.clamp_(min=0)
+
+    return optimizer.register_step_post_hook(hook)
+
 
 class SparseCoding(nn.Module):
     def __init__(self, S, D, learn_D, seed: int = 42):
         super().__init__()
         self.learn_D = learn_D
         torch.manual_seed(seed + 42)
-        self.log_S_ = nn.Parameter(data=-10 * torch.ones(S.shape[0], D.shape[0]), requires_grad=True)
+        self.S_raw_ = nn.Parameter(data=1e-3 * torch.ones(S.shape[0], D.shape[0]), requires_grad=True)
         if learn_D:
             self.D_ = nn.Parameter(data=torch.randn(D.shape), requires_grad=True)
+            self.D_.data /= torch.linalg.norm(self.D_, dim=1, keepdim=True)
         else:
             self.D_ = nn.Parameter(data=D, requires_grad=False)
+        # (key, state) of the last infer() call, reused when the next call has the same setup
+        self._infer_cache = None
 
     def forward(self, X = None):
-        if self.learn_D:
-            self.D_.data /= torch.linalg.norm(self.D_, dim=1, keepdim=True)
-        S_ = torch.exp(self.log_S_)
-        X_ = S_ @ self.D_
-        return S_, X_
+        # S_raw_ is kept non-negative by register_code_projection_hook, not by a ReLU on the tape
+        S_ = self.S_raw_
+        with _autocast(self.D_.device):
+            X_ = _decode(S_, self.D_)
+        return S_, X_.float()
+
+    def __getstate__(self):
+        # The infer() cache holds a live CUDA graph (unpicklable), an optimizer and a copy of X;
+        # pickled and deep-copied models leave it behind and rebuild it on their first infer()
+        state = super().__getstate__()
+        state['_infer_cache'] = None
+        return state
+
+    def _infer_state(self, X, lr, l1_weight):
+        # The code parameter, Adam state, a static copy of X and the captured CUDA graph are kept
+        # between calls; a repeated call with the same setup only resets them in place.
+        key = (tuple(X.shape), X.device, X.dtype, lr, l1_weight, self.D_.data_ptr())
+        if self._infer_cache is not None and self._infer_cache[0] == key:
+            state = self._infer_cache[1]
+            state['S_raw_'].data.fill_(1e-3)
+            for s in state['optimizer'].state.values():
+                s['exp_avg'].zero_()
+                s['exp_avg_sq'].zero_()
+                s['step'].zero_()
+            state['X'].copy_(X)
+            return state
 
-    def infer(self, X, num_iterations=10000, lr=3e-3, l1_weight=1e-3):
         # Initialize S_ randomly
         #S_ = torch.randn(X.shape[0], self.D_.shape[0], device=X.device, requires_grad=True)
-        self.log_S_ = nn.Parameter(data=-10 * torch.ones(X.shape[0], self.D_.shape[0]), requires_grad=True)
+        S_raw_ = nn.Parameter(data=1e-3 * torch.ones(X.shape[0], self.D_.shape[0], device=X.device), requires_grad=True)
+        state = {
+            'S_raw_': S_raw_,
+            'optimizer': torch.optim.Adam([S_raw_], lr=lr, capturable=X.is_cuda),
+            'X': X.clone(),
+            'graph': None,
+        }
+        self._infer_cache = (key, state)
+        return state
 
-        optimizer = torch.optim.Adam([self.log_S_], lr=lr)
+    def infer(self, X, num_iterations=10000, lr=3e-3, l1_weight=1e-3):
+        state = self._infer_state(X, lr, l1_weight)
+        self.S_raw_ = state['S_raw_']
+        optimizer = state['optimizer']
+        X = state['X']
 
-        for _ in tqdm(range(num_iterations), desc='Infer'):
-            optimizer.zero_grad()
+        # On CUDA the whole step (forward, backward, Adam update) is captured once
+        # in a CUDA graph and replayed, so the loop is no longer launch-bound
+        use_graph = X.is_cuda
 
-            S_ = torch.exp(self.log_S_)
+        def step():
+            # S_raw_ is projected back onto S_ >= 0 after every update, so
+            # it can be used as the code directly (no ReLU on the tape)
+            S_ = self.S_raw_
 
-            # Compute reconstruction
-            X_ = S_ @ self.D_
+            # Compute reconstruction (bf16 matmul on CUDA; S_raw_ and its Adam state stay fp32)
+            with _autocast(X.device):
+                X_ = _decode(S_, self.D_)
 
             # Compute loss (reconstruction error + L1 penalty)
-            loss = F.mse_loss(X_, X) + l1_weight * torch.sum(torch.abs(S_))
+            loss = mse_l1_loss(X_, X, S_, l1_weight)
 
             # Backward pass
             loss.backward()
@@ -47,15 +137,41 @@ class SparseCoding(nn.Module):
             # Update S_
             optimizer.step()
 
-            # Apply ReLU to ensure non-negativity (if this constraint is desired)
-            S_.data = F.relu(S_.data)
+            # Project onto the non-negative orthant
+            with torch.no_grad():
+                self.S_raw_.clamp_(min=0)
+
+        if use_graph:
+            num_warmup = 0
+            if state['graph'] is None:
+                num_warmup = min(3, num_iterations)
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    for _ in range(num_warmup):
+                        optimizer.zero_grad(set_to_none=True)
+                        step()
+                torch.cuda.current_stream().wait_stream(stream)
+
+                state['graph'] = torch.cuda.CUDAGraph()
+                optimizer.zero_grad(set_to_none=True)
+                with torch.cuda.graph(state['graph']):
+                    step()
+
+            for _ in tqdm(range(num_iterations - num_warmup), desc='Infer'):
+                state['graph'].replay()
+        else:
+            for _ in tqdm(range(num_iterations), desc='Infer'):
+                optimizer.zero_grad()
+                step()
 
-        return S_.detach()
+        # S_raw_ is reused by the next call, so hand out a copy
+        return self.S_raw_.detach().clone()
 
     
     def loss_forward(self, X, weight):
-        S_, X_ = self.forward(X)
-        loss = torch.sum((X - X_) ** 2) + weight * torch.sum(torch.abs(S_))
+        S_, X_ = self(X)
+        loss = F.mse_loss(X_, X, reduction='sum') + weight * torch.sum(torch.abs(S_))
         return S_, X_, loss
 
 class Exp(nn.Module):
@@ -78,19 +194,19 @@ class SparseAutoEncoder(nn.Module):
             self.encoder = nn.Sequential(nn.Linear(M, N), Exp())
         if learn_D:
             self.D_ = nn.Parameter(data=torch.randn(D.shape), requires_grad=True)
+            self.D_.data /= torch.linalg.norm(self.D_, dim=1, keepdim=True)
         else:
             self.D_ = nn.Parameter(data=D, requires_grad=False)
 
     def forward(self, X):
-        if self.learn_D:
-            self.D_.data /= torch.linalg.norm(self.D_, dim=1, keepdim=True)
-        S_ = self.encoder(X)
-        X_ = S_ @ self.D_
-        return S_, X_
+        with _autocast(X.device):
+            S_ = self.encoder(X)
+            X_ = _decode(S_, self.D_)
+        return S_.float(), X_.float()
     
     def loss_forward(self, X, weight):
-        S_, X_ = self.forward(X)
-        loss = torch.sum((X - X_) ** 2) + weight * torch.sum(torch.abs(S_))
+        S_, X_ = self(X)
+        loss = F.mse_loss(X_, X, reduction='sum') + weight * torch.sum(torch.abs(S_))
         return S_, X_, loss
 
 class GatedSAE(nn.Module):
@@ -107,17 +223,52 @@ class GatedSAE(nn.Module):
             self.D_ = nn.Parameter(D, requires_grad=False)
 
         self.W_gate = nn.Parameter(torch.nn.init.kaiming_uniform_(torch.empty(M, N)), requires_grad=True)
-        self.b_dec = nn.Parameter(torch.zeros(M))
-        self.b_enc_gate = nn.Parameter(torch.zeros(N))
-        self.b_dec_gate = nn.Parameter(torch.zeros(M))
-        self.r_mag = nn.Parameter(torch.zeros(N))
-        self.b_mag = nn.Parameter(torch.zeros(N))
-        self.b_gate = nn.Parameter(torch.zeros(N))
+        # biases packed into one parameter per size: rows of biases_N are r_mag, b_mag,
+        # b_gate, b_enc_gate and rows of biases_M are b_dec, b_dec_gate (see properties below)
+        self.biases_N = nn.Parameter(torch.zeros(4, N))
+        self.biases_M = nn.Parameter(torch.zeros(2, M))
+
+        # detached D_ / b_dec used by the auxiliary gate loss, see _detached_decoder
+        self._detached_decoder_key = None
 
         self.D_.data /= torch.linalg.norm(self.D_, dim=1, keepdim=True)
 
         self.d_hidden = N
 
+    @property
+    def r_mag(self):
+        return self.biases_N[0]
+
+    @property
+    def b_mag(self):
+        return self.biases_N[1]
+
+    @property
+    def b_gate(self):
+        return self.biases_N[2]
+
+    @property
+    def b_enc_gate(self):
+        return self.biases_N[3]
+
+    @property
+    def b_dec(self):
+        return self.biases_M[0]
+
+    @property
+    def b_dec_gate(self):
+        return self.biases_M[1]
+
+    def _detached_decoder(self):
+        # Detached aliases share storage with D_ and biases_M, so they stay current through in-place
+        # optimizer updates and only need rebuilding when the parameters are re-allocated.
+        key = (self.D_.data_ptr(), self.biases_M.data_ptr())
+        if key != self._detached_decoder_key:
+            self._D_detached = self.D_.detach()
+            self._b_dec_detached = self.biases_M.detach()[0]
+            self._detached_decoder_key = key
+        return self._D_detached, self._b_dec_detached
+
     # def forward(self, X):
     #     preactivations_hidden = einops.einsum(X - self.b_dec, self.W_gate, "... input_dim, input_dim hidden_dim -> ... hidden_dim")
     #     pre_mag_hidden = preactivations_hidden * torch.exp(self.r_mag) + self.b_mag
@@ -129,17 +280,15 @@ class GatedSAE(nn.Module):
     #     return S_, X_, pre_gate_hidden
 
     def forward(self, X):
-        if self.learn_D:
-            self.D_.data /= torch.linalg.norm(self.D_, dim=1, keepdim=True)
-
-        preactivations_hidden = torch.matmul(X - self.b_dec, self.W_gate)
-        pre_mag_hidden = preactivations_hidden * torch.exp(self.r_mag) + self.b_mag
-        post_mag_hidden = torch.relu(pre_mag_hidden)
-        pre_gate_hidden = preactivations_hidden + self.b_gate
-        post_gate_hidden = (torch.sign(pre_gate_hidden) + 1) / 2
-        S_ = post_mag_hidden * post_gate_hidden
-        X_ = torch.matmul(S_, self.D_) + self.b_dec
-        return S_, X_, pre_gate_hidden
+        with _autocast(X.device):
+            preactivations_hidden = torch.matmul(X - self.b_dec, self.W_gate)
+            pre_mag_hidden = preactivations_hidden * torch.exp(self.r_mag) + self.b_mag
+            post_mag_hidden = torch.relu(pre_mag_hidden)
+            pre_gate_hidden = preactivations_hidden + self.b_gate
+            post_gate_hidden = (pre_gate_hidden > 0).to(pre_gate_hidden.dtype)
+            S_ = post_mag_hidden * post_gate_hidden
+            X_ = _decode(S_, self.D_, self.b_dec)
+        return S_.float(), X_.float(), pre_gate_hidden.float()
 
     # def loss_forward(self, X, weight):
     #     S_, X_, pre_gate_hidden = self.forward(X)
@@ -152,12 +301,14 @@ class GatedSAE(nn.Module):
     #     return S_, X_, gated_sae_loss
 
     def loss_forward(self, X, l1_weight):
-        S_, X_, pre_gate_hidden = self.forward(X)
+        S_, X_, pre_gate_hidden = self(X)
         gated_sae_loss = F.mse_loss(X_, X, reduction='mean') #(X_ - X).pow(2).mean()
         gate_magnitude = F.relu(pre_gate_hidden)
         gated_sae_loss += l1_weight * gate_magnitude.sum()
-        gate_reconstruction = torch.matmul(gate_magnitude, self.D_.detach()) + self.b_dec.detach()
-        auxiliary_loss = F.mse_loss(gate_reconstruction, X, reduction='mean')
+        with _autocast(X.device):
+            D_detached, b_dec_detached = self._detached_decoder()
+            gate_reconstruction = _decode(gate_magnitude, D_detached, b_dec_detached)
+        auxiliary_loss = F.mse_loss(gate_reconstruction.float(), X, reduction='mean')
         gated_sae_loss += auxiliary_loss
         return S_, X_, gated_sae_loss
 
@@ -170,17 +321,38 @@ class GatedSAE(nn.Module):
 
 ### TOP-K Sparse Autoencoder ###
 
+class TopKActivation(NamedTuple):
+    values: torch.Tensor
+    indices: torch.Tensor
+
+
 class TopK(nn.Module):
-    def __init__(self, k: int, postact_fn: nn.Module = nn.ReLU()):
+    def __init__(self, k: int, postact_fn: nn.Module = nn.ReLU(), approx_min_dim: int = 2 ** 16,
+                 cpu_min_dim: int = 2 ** 12):
         super().__init__()
         self.k = k
         self.postact_fn = postact_fn
-
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        topk = torch.topk(x, k=self.k, dim=-1)
-        values = self.postact_fn(topk.values)
-        result = torch.zeros_like(x)
-        result.scatter_(-1, topk.indices, values)
+        # use the bucketed approximate top-k while training on rows at least this long
+        self.approx_min_dim = approx_min_dim
+        # use the AVX2 kernel for no-grad CPU rows at least this long (torch.topk is faster below)
+        self.cpu_min_dim = cpu_min_dim
+
+    def forward(self, x: torch.Tensor) -> TopKActivation:
+        if self.training and x.shape[-1] >= self.approx_min_dim:
+            values, indices = approx_topk(x, k=self.k, dim=-1, j=2, k_mult=4)
+        elif x.device.type == 'cpu' and not x.requires_grad and x.shape[-1] >= self.cpu_min_dim:
+            values, indices = cpu_topk(x, k=self.k)
+        else:
+            # selected values feed a scatter/gather, so their order is irrelevant
+            values, indices = torch.topk(x, k=self.k, dim=-1, sorted=False)
+        values = self.postact_fn(values)
+        return TopKActivation(values, indices)
+
+    def to_dense(self, act: TopKActivation, x: torch.Tensor) -> torch.Tensor:
+        # Allocated per call: the result is handed to callers, and torch's caching allocator
+        # already reuses the block for same-shape calls.
+        result = torch.zeros_like(x, dtype=act.values.dtype)
+        result.scatter_(-1, act.indices, act.values)
         return result
 
 class TopKSAE(nn.Module):
@@ -196,25 +368,36 @@ class TopKSAE(nn.Module):
         
         if learn_D:
             self.D_ = nn.Parameter(data=torch.randn(D.shape), requires_grad=True)
+            self.D_.data /= torch.linalg.norm(self.D_, dim=1, keepdim=True)
         else:
             self.D_ = nn.Parameter(data=D, requires_grad=False)
         
         self.pre_bias = nn.Parameter(torch.zeros(M))
 
-    def forward(self, X):
-        if self.learn_D:
-            self.D_.data /= torch.linalg.norm(self.D_, dim=1, keepdim=True)
-        
+    def encode(self, X):
         X_centered = X - self.pre_bias
-        S_pre_act = self.encoder(X_centered) + self.latent_bias
-        S_ = self.activation(S_pre_act)
-        X_ = S_ @ self.D_ + self.pre_bias
+        with _autocast(X.device):
+            S_pre_act = self.encoder(X_centered)
+        S_pre_act = S_pre_act.float() + self.latent_bias
+        return S_pre_act, self.activation(S_pre_act)
+
+    def forward(self, X):
+        S_pre_act, act = self.encode(X)
+        S_ = self.activation.to_dense(act, S_pre_act)
+        # Decode from the k active rows of D_ only instead of the dense S_: (B, 1, k) @ (B, k, M)
+        B, k = act.indices.shape
+        D_sel = self.D_.index_select(0, act.indices.reshape(-1)).view(B, k, -1)
+        with _autocast(X.device):
+            X_ = torch.baddbmm(self.pre_bias.expand(B, 1, -1), act.values.unsqueeze(1), D_sel).squeeze(1)
+        X_ = X_.float()
         
         return S_, X_
 
     def loss_forward(self, X, weight):
-        S_, X_ = self.forward(X)
-        loss = F.mse_loss(X_, X, reduction='sum')
+        S_pre_act, act = self.encode(X)
+        S_ = self.activation.to_dense(act, S_pre_act)
+        # Fused decode + MSE straight from the top-k indices/values
+        loss, X_ = topk_sae_loss(act.indices, self.D_, act.values, self.pre_bias, X)
         return S_, X_, loss
 
     @property
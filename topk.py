@@ -0,0 +1,84 @@
+import ctypes
+import functools
+import math
+import os
+import subprocess
+import torch
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def approx_topk(x, k, dim=-1, j=2, k_mult=4):
+    """Bucketed approximate top-k along `dim`.
+
+    `x` is split into b = ceil(k * k_mult / j) interleaved buckets, the top `j` of every bucket are kept
+    and the exact top-k is taken over the b * j candidates. All buckets are reduced in parallel, which is
+    much cheaper than one exact top-k over a long row; elements can only be missed when more than `j` of
+    the true top-k fall into the same bucket. Returns (values, indices) in no particular order.
+    """
+    x = x.movedim(dim, -1)
+    N = x.shape[-1]
+    num_buckets = math.ceil(k * k_mult / j)
+    bucket_size = math.ceil(N / num_buckets)
+    if bucket_size - 1 < j:
+        values, indices = torch.topk(x, k=k, dim=-1, sorted=False)
+        return values.movedim(-1, dim), indices.movedim(-1, dim)
+
+    # element n goes to bucket n % num_buckets; padding only ever lands in the last slot of a bucket
+    padded = torch.nn.functional.pad(x, (0, bucket_size * num_buckets - N), value=-math.inf)
+    buckets = padded.unflatten(-1, (bucket_size, num_buckets))
+    if j == 1:
+        values, slots = buckets.max(dim=-2, keepdim=True)
+    else:
+        values, slots = torch.topk(buckets, k=j, dim=-2, sorted=False)
+    offsets = torch.arange(num_buckets, device=x.device)
+    indices = (slots * num_buckets + offsets).flatten(-2)
+    values = values.flatten(-2)
+
+    if values.shape[-1] > k:
+        values, candidates = torch.topk(values, k=k, dim=-1, sorted=False)
+        indices = indices.gather(-1, candidates)
+    return values.movedim(-1, dim), indices.movedim(-1, dim)
+
+
+@functools.lru_cache(maxsize=None)
+def _fast_topk_lib():
+    # build the AVX2 kernel next to its source on first use; None if no compiler is available
+    src = os.path.join(_HERE, 'fast_topk.c')
+    lib_path = os.path.join(_HERE, 'libfast_topk.so')
+    try:
+        if not os.path.exists(lib_path) or os.path.getmtime(lib_path) < os.path.getmtime(src):
+            flags = ['-O3', '-march=native', '-mavx2', '-fPIC', '-shared']
+            try:
+                subprocess.run(['cc', *flags, '-fopenmp', src, '-o', lib_path], check=True, capture_output=True)
+            except subprocess.CalledProcessError:
+                subprocess.run(['cc', *flags, src, '-o', lib_path], check=True, capture_output=True)
+        lib = ctypes.CDLL(lib_path)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    lib.fast_topk_batched.argtypes = [ctypes.c_void_p, ctypes.c_int64, ctypes.c_int64, ctypes.c_int64,
+                                      ctypes.c_void_p, ctypes.c_void_p]
+    lib.fast_topk_batched.restype = ctypes.c_int
+    return lib
+
+
+@torch.compiler.disable
+def cpu_topk(x, k):
+    """Exact top-k over the last dim of a CPU float32 tensor using the AVX2 kernel in fast_topk.c.
+
+    Not differentiable; falls back to torch.topk when the kernel cannot be used, and for inputs with
+    NaNs, which torch.topk ranks highest but the kernel's compares skip (it only reports them).
+    Returns (values, indices) in no particular order.
+    """
+    lib = _fast_topk_lib()
+    if (lib is None or x.dtype != torch.float32 or x.device.type != 'cpu' or x.requires_grad
+            or not 0 < k <= x.shape[-1]):
+        return torch.topk(x, k=k, dim=-1, sorted=False)
+    rows = x.reshape(-1, x.shape[-1]).contiguous()
+    values = torch.empty(rows.shape[0], k, dtype=torch.float32)
+    indices = torch.empty(rows.shape[0], k, dtype=torch.int64)
+    has_nan = lib.fast_topk_batched(rows.data_ptr(), rows.shape[0], rows.shape[1], k,
+                                    values.data_ptr(), indices.data_ptr())
+    if has_nan:
+        return torch.topk(x, k=k, dim=-1, sorted=False)
+    return values.view(*x.shape[:-1], k), indices.view(*x.shape[:-1], k)